@@ -44,11 +44,21 @@ __all__ = ['create_basic_corpus']
 
 import argparse
 import csv
+import json
+import os
 import pathlib
 import pickle
+import shutil
 import subprocess
 import sys
-from typing import Union, List, Optional
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict, Tuple, Iterator
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 SPEAKERS_GENDER = {
     'nl1': 'm', 'nl2': 'm', 'nl3': 'f',
@@ -59,87 +69,222 @@ SPEAKERS_GENDER = {
 }
 
 
-def generate_pitch_contour_pho_line(pitch_type: str, speaker_id: str) -> str:
-    # pitch contour for female (_f) and male (_m) voices
-    falling_m = [112, 132, 92]
-    falling_f = [189, 223, 155]
-    rising_m = [112, 132]
-    rising_f = [189, 223]
+# pitch contour pho fragments for female (_F) and male (_M) voices
+FALLING_M = '(1,  112) (20, 132) (28, 132) (100, 92)'
+FALLING_F = '(1,  189) (20, 223) (28, 223) (100, 155)'
+RISING_M = '(1, 112) (100, 132)'
+RISING_F = '(1, 189) (100, 223)'
 
-    if SPEAKERS_GENDER[speaker_id] == 'f':
-        contour = falling_f if pitch_type == 'f' else rising_f
-    else:
-        contour = falling_m if pitch_type == 'f' else rising_m
+# pho fragments by speaker gender (female: f, male: m) and pitch type (falling: f, rising: r)
+PITCH_FRAGMENTS = {
+    ('m', 'f'): FALLING_M,
+    ('m', 'r'): RISING_M,
+    ('f', 'f'): FALLING_F,
+    ('f', 'r'): RISING_F
+}
 
-    if pitch_type == 'r':
-        pho_line = '(1, {0}) (100, {1})'.format(*contour)
-    else:
-        pho_line = '(1,  {0}) (20, {1}) (28, {1}) (100, {2})'.format(*contour)
-
-    return pho_line
-
-
-def create_pho_files(lang: str, vowels: List[str], speakers: List[str], corpus_info: dict,
-                     output_path: Union[str, pathlib.Path], vowel_duration: Optional[int] = 500) -> dict:
-
-    for speaker in speakers:
-        # keys format: lang_speaker_pitch_sequence. Counting by speaker
-        prev_seq = [int(curr_files[-3:]) for curr_files in corpus_info.keys() if speaker in curr_files]
-        if len(prev_seq) > 0:
-            seq = sorted(prev_seq,reverse=True)[0]
-            seq += 1
-        else:
-            seq = 1
-        for vowel in vowels:
-            for pitch in ['f', 'r']:  # falling and rising
-                title = f'{lang}_{speaker}_{pitch}_{seq:03d}.pho'
-                line = f'{vowel} {vowel_duration} {generate_pitch_contour_pho_line(pitch, speaker)}'
-                with open(pathlib.Path(output_path).joinpath(title), 'w') as file:
-                    file.write(line)
-                corpus_info[title.replace('.pho', '')] = {'vowel': vowel, 'details': {'language': lang},
-                                                          'vowel_onset': 0, 'vowel_offset': vowel_duration,
-                                                          'speaker': speaker}
-                seq += 1
+# (falling, rising) pho fragments per speaker
+SPEAKER_FRAGMENTS = {speaker: (PITCH_FRAGMENTS[(gender, 'f')], PITCH_FRAGMENTS[(gender, 'r')])
+                     for speaker, gender in SPEAKERS_GENDER.items()}
+
+
+@dataclass
+class CorpusInfo:
+    """
+    Meta-data of the corpus stored by columns, one entry per synthesised file (lang_speaker_pitch_sequence).
+    """
+    filenames: List[str] = field(default_factory=list)
+    vowels: List[str] = field(default_factory=list)
+    speakers: List[str] = field(default_factory=list)
+    languages: List[str] = field(default_factory=list)
+    onsets: List[int] = field(default_factory=list)
+    offsets: List[int] = field(default_factory=list)
+
+    def append(self, filename: str, vowel: str, speaker: str, language: str, onset: int, offset: int) -> None:
+        self.filenames.append(filename)
+        self.vowels.append(vowel)
+        self.speakers.append(speaker)
+        self.languages.append(language)
+        self.onsets.append(onset)
+        self.offsets.append(offset)
+
+    def rows(self) -> Iterator[Tuple[str, str, str, str, int, int]]:
+        # (filename, vowel, speaker, language, onset, offset) per file
+        return zip(self.filenames, self.vowels, self.speakers, self.languages, self.onsets, self.offsets)
+
+    def to_dict(self) -> dict:
+        # legacy layout (filename -> details), used for the pickle file
+        return {filename: {'vowel': vowel, 'details': {'language': language}, 'vowel_onset': onset,
+                           'vowel_offset': offset, 'speaker': speaker}
+                for filename, vowel, speaker, language, onset, offset in self.rows()}
+
+    def to_flat_dict(self) -> dict:
+        # flat layout (filename -> vowel, vowel_onset, vowel_offset, speaker, language), used for json and msgpack
+        return {filename: {'vowel': vowel, 'vowel_onset': onset, 'vowel_offset': offset, 'speaker': speaker,
+                           'language': language}
+                for filename, vowel, speaker, language, onset, offset in self.rows()}
+
+
+def create_pho_tasks(vowels: Dict[str, List[List[str]]],
+                     speakers: Dict[str, List[List[str]]]) -> List[Tuple[str, str, str, str, str]]:
+    # (language, speaker, vowel, pitch, pitch contour fragment) for every file of the corpus, in sequence order
+    return [(language, speaker, vowel, pitch, pitch_fragment)
+            for language in vowels
+            for config_vowels, config_speakers in zip(vowels[language], speakers[language])
+            for speaker in config_speakers
+            for vowel in config_vowels
+            for pitch, pitch_fragment in zip(('f', 'r'), SPEAKER_FRAGMENTS[speaker])]  # falling and rising
+
+
+def create_pho_files(tasks: List[Tuple[str, str, str, str, str]], corpus_info: CorpusInfo,
+                     output_path: Optional[pathlib.Path], pho_lines: Dict[str, str],
+                     vowel_duration: Optional[int] = 500) -> CorpusInfo:
+    """
+    Generates the pho lines of the tasks into pho_lines and corpus_info. The pho files are only written to disk when
+    output_path is given.
+    """
+    # keys format: lang_speaker_pitch_sequence. Counting by speaker (last sequence used in speaker_seq)
+    speaker_seq = defaultdict(int)
+    writes = []
+    for lang, speaker, vowel, pitch, pitch_fragment in tasks:
+        seq = speaker_seq[speaker] + 1
+        name = f'{lang}_{speaker}_{pitch}_{seq:03d}'
+        line = f'{vowel} {vowel_duration} {pitch_fragment}'
+        writes.append((f'{name}.pho', line.encode('ascii')))
+        corpus_info.append(name, vowel, speaker, lang, 0, vowel_duration)
+        pho_lines[name] = line
+        speaker_seq[speaker] = seq
+
+    if output_path is None:
+        return corpus_info
+
+    output_path = os.fspath(output_path)
+    # pho files are a few bytes long, write them unbuffered instead of through open(). When supported, the files
+    # are opened relative to a descriptor of the output folder to avoid resolving the full path on every write
+    dir_fd = os.open(output_path, os.O_RDONLY | os.O_DIRECTORY) if os.open in os.supports_dir_fd else None
+    try:
+        for title, content in writes:
+            if dir_fd is None:
+                fd = os.open(os.path.join(output_path, title), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            else:
+                fd = os.open(title, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644, dir_fd=dir_fd)
+            try:
+                os.write(fd, content)
+            finally:
+                os.close(fd)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
     return corpus_info
 
 
-def synthesise_pho_files(dir_pho_files: Union[str, pathlib.Path], mbrola_exe_path: Union[str, pathlib.Path],
-                         voices_path: Union[str, pathlib.Path], output_path: Union[str, pathlib.Path]) -> None:
-    pho_files = list(pathlib.Path(dir_pho_files).iterdir())
-
-    mbrola_exe_path = pathlib.Path(mbrola_exe_path)
-    voices_path = pathlib.Path(voices_path)
-    pathlib.Path(output_path).mkdir(parents=True, exist_ok=True)
-
-    for pho_file in pho_files:
-        name = pho_file.resolve().stem
-        voice = name.split('_')[1]  # lang_speaker_pitch_sequence
-        wav_file = pathlib.Path(output_path).joinpath(f'{name}.wav')
-        # command = f'{mbrola_exe} {voice_path.joinpath(voice)} {pho_file} {wav_file}'
-        command = [mbrola_exe_path, voices_path.joinpath(voice), pho_file, wav_file]
-        try:
-            subprocess.run(command, check=True)
-        except subprocess.CalledProcessError as e:
-            print(pho_file)
+def start_mbrola_process(name: str, pho_line: str, mbrola_exe_path: str, voices_path: str,
+                         output_path: str) -> subprocess.Popen:
+    voice = name.split('_', 2)[1]  # lang_speaker_pitch_sequence
+    wav_file = os.path.join(output_path, f'{name}.wav')
+    # the pho content is streamed through stdin ('-') instead of reading the pho file again
+    command = [mbrola_exe_path, os.path.join(voices_path, voice), '-', wav_file]
+    # MBROLA progress output is discarded, the error message is recovered in wait_mbrola_process if it fails
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               shell=False)
+    try:
+        process.stdin.write(pho_line.encode('ascii'))
+        process.stdin.close()
+    except BrokenPipeError:
+        # MBROLA exited before reading the pho line (e.g. bad voice), wait_mbrola_process reports the exit status
+        pass
+    return process
+
+
+def wait_mbrola_process(name: str, pho_line: str, process: subprocess.Popen) -> None:
+    if process.wait() != 0:
+        # run it again capturing stderr to report why it failed
+        result = subprocess.run(process.args, input=pho_line.encode('ascii'), stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, shell=False)
+        if result.returncode == 0:
+            print(f'{name}: MBROLA exited with status {process.returncode}, succeeded on retry')
+            return
+        message = result.stderr.decode(errors='replace').strip()
+        print(f'{name}: MBROLA exited with status {result.returncode}' + (f': {message}' if message else ''))
+
+
+def synthesise_pho_lines(pho_lines: Dict[str, str], mbrola_exe_path: pathlib.Path,
+                         voices_path: pathlib.Path, output_path: pathlib.Path,
+                         max_workers: Optional[int] = None) -> None:
+    output_path.mkdir(parents=True, exist_ok=True)
+    mbrola_exe_path = os.fspath(mbrola_exe_path)
+    voices_path = os.fspath(voices_path)
+    output_path = os.fspath(output_path)
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # keep up to max_workers MBROLA processes running, the next one starts as soon as the oldest finishes. Files are
+    # grouped by voice so consecutive processes load the same voice database (already in the page cache)
+    running = deque()
+    try:
+        for name, pho_line in sorted(pho_lines.items(), key=lambda item: item[0].split('_', 2)[1]):
+            if len(running) >= max_workers:
+                wait_mbrola_process(*running.popleft())
+            running.append((name, pho_line,
+                            start_mbrola_process(name, pho_line, mbrola_exe_path, voices_path, output_path)))
+        while running:
+            wait_mbrola_process(*running.popleft())
+    finally:
+        # only reached with processes left when the dispatch failed, do not leave them running
+        for _, _, process in running:
+            process.kill()
+            process.wait()
+
+
+def create_corpus_info_csv_file(output_corpus_path: pathlib.Path, corpus_info: CorpusInfo) -> None:
+    header = ['filename', 'vowel', 'vowel_onset', 'vowel_offset', 'mbrola_voice', 'language']
+    # the MBROLA voice is the speaker id
+    rows = sorted((filename, vowel, onset, offset, speaker, language)
+                  for filename, vowel, speaker, language, onset, offset in corpus_info.rows())
+    csv_path = output_corpus_path.joinpath('corpus_info.csv')
+
+    # only the vowel symbols could need csv quoting, otherwise the file is written at once without csv.writer
+    if any(char in vowel for vowel in corpus_info.vowels for char in ',"\r\n'):
+        with open(csv_path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file, delimiter=',')
+            writer.writerow(header)
+            writer.writerows(rows)
+        return
+
+    lines = [','.join(header)]
+    lines.extend(f'{filename},{vowel},{onset},{offset},{voice},{language}'
+                 for filename, vowel, onset, offset, voice, language in rows)
+    lines.append('')  # csv.writer terminates every row, including the last one
+    csv_path.write_bytes('\r\n'.join(lines).encode('utf-8'))
+
+
+def save_corpus_info(output_corpus_info_path: pathlib.Path, corpus_info: CorpusInfo) -> None:
+    """
+    Saves the corpus meta-data. The format is chosen by the file extension: .json and .msgpack store a flat
+    schema (filename -> vowel, vowel_onset, vowel_offset, speaker, language), any other extension keeps the
+    legacy pickle (dictionary filename -> details).
+    """
+    output_corpus_info_path.parent.mkdir(parents=True, exist_ok=True)
+    suffix = output_corpus_info_path.suffix.lower()
+
+    if suffix not in ('.json', '.msgpack'):
+        with open(output_corpus_info_path, 'wb') as data_file:
+            pickle.dump(corpus_info.to_dict(), data_file)
+        return
+
+    flat_info = corpus_info.to_flat_dict()
+    if suffix == '.json':
+        with open(output_corpus_info_path, 'w', encoding='utf-8') as data_file:
+            json.dump(flat_info, data_file, separators=(',', ':'))
+    else:
+        with open(output_corpus_info_path, 'wb') as data_file:
+            msgpack.pack(flat_info, data_file, use_bin_type=True)
 
 
-def create_corpus_info_csv_file(output_corpus_path: Union[str, pathlib.Path], corpus_info: dict) -> None:
-    header = ['filename', 'vowel', 'vowel_onset', 'vowel_offset', 'mbrola_voice', 'language']
-    lines = []
-    for filename in sorted(corpus_info.keys()):
-        lines.append([filename, corpus_info[filename]['vowel'], corpus_info[filename]['vowel_onset'],
-                      corpus_info[filename]['vowel_offset'], filename.split('_')[1],
-                      corpus_info[filename]['details']['language']])
-    with open(pathlib.Path(output_corpus_path).joinpath('corpus_info.csv'), 'w') as csv_file:
-        writer = csv.writer(csv_file, delimiter=',')
-        writer.writerow(header)
-        writer.writerows(lines)
-
-
-def create_basic_corpus(output_corpus_path: Union[str, pathlib.Path],
-                        output_corpus_info_path: Union[str, pathlib.Path],
-                        mbrola_path: Union[str, pathlib.Path],
-                        mbrola_voices_path: Union[str, pathlib.Path]) -> None:
+def create_basic_corpus(output_corpus_path: pathlib.Path,
+                        output_corpus_info_path: pathlib.Path,
+                        mbrola_path: pathlib.Path,
+                        mbrola_voices_path: pathlib.Path,
+                        keep_pho: bool = True) -> None:
     vowels = {
         'en': [['A', 'i', 'I', 'E', 'u', '{']],
         'nl': [['I', 'i', 'E', 'u']],
@@ -155,29 +300,50 @@ def create_basic_corpus(output_corpus_path: Union[str, pathlib.Path],
         'jp': [['jp1', 'jp2', 'jp3'], ['jp2']]
     }
 
-    corpus_info = {}
+    # fail before synthesising anything if the meta-data could not be saved at the end
+    if output_corpus_info_path.suffix.lower() == '.msgpack' and msgpack is None:
+        raise ImportError('msgpack is required to save the corpus meta-data as .msgpack')
+
+    corpus_info = CorpusInfo()
+    pho_lines = {}
 
-    languages = list(vowels.keys())
-    pho_folder = pathlib.Path(output_corpus_path).joinpath('pho')
-    pho_folder.mkdir(parents=True, exist_ok=True)
+    # MBROLA reads the pho lines from memory, the pho folder is only written to keep a copy in the corpus
+    pho_folder = None
+    if keep_pho:
+        pho_folder = output_corpus_path.joinpath('pho')
+        pho_folder.mkdir(parents=True, exist_ok=True)
 
-    for language in languages:
-        for config_idx in range(len(vowels[language])):
-            corpus_info = create_pho_files(language, vowels[language][config_idx], speakers[language][config_idx],
-                                           corpus_info, pho_folder)
+    corpus_info = create_pho_files(create_pho_tasks(vowels, speakers), corpus_info, pho_folder, pho_lines)
 
-    wav_folder = pathlib.Path(output_corpus_path).joinpath('wav')
+    wav_folder = output_corpus_path.joinpath('wav')
     wav_folder.mkdir(parents=True, exist_ok=True)
 
-    synthesise_pho_files(pho_folder, mbrola_path, mbrola_voices_path, wav_folder)
+    synthesise_pho_lines(pho_lines, mbrola_path, mbrola_voices_path, wav_folder)
 
-    pathlib.Path(output_corpus_info_path).parent.mkdir(parents=True, exist_ok=True)
-    with open(output_corpus_info_path, 'wb') as data_file:
-        pickle.dump(corpus_info, data_file)
+    save_corpus_info(output_corpus_info_path, corpus_info)
 
     create_corpus_info_csv_file(output_corpus_path, corpus_info)
 
 
+def existing_path(path: str) -> pathlib.Path:
+    try:
+        return pathlib.Path(path).expanduser().resolve(strict=True)
+    except FileNotFoundError:
+        raise argparse.ArgumentTypeError(f'{path} does not exist')
+
+
+def executable_path(path: str) -> pathlib.Path:
+    # commands available on PATH (e.g. a packaged mbrola) are accepted as well as paths to the executable
+    executable = shutil.which(path)
+    if executable is None:
+        return existing_path(path)
+    return pathlib.Path(executable).resolve()
+
+
+def resolved_path(path: str) -> pathlib.Path:
+    return pathlib.Path(path).expanduser().resolve()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Script to create Isolated vowels corpus with MBROLA. \nUsage: python'
                                                  'create_isolated_vowels_corpus.py '
@@ -186,13 +352,16 @@ if __name__ == '__main__':
                                                  '--output_corpus_path path_corpus '
                                                  '--output_info path_corpus_info_file')
 
-    parser.add_argument('--mbrola_path', type=str, required=True)
-    parser.add_argument('--mbrola_voices_path', type=str, required=True)
-    parser.add_argument('--output_corpus_path', type=str, required=True)
-    parser.add_argument('--output_info', type=str, required=True)
+    parser.add_argument('--mbrola_path', type=executable_path, required=True)
+    parser.add_argument('--mbrola_voices_path', type=existing_path, required=True)
+    parser.add_argument('--output_corpus_path', type=resolved_path, required=True)
+    parser.add_argument('--output_info', type=resolved_path, required=True)
+    parser.add_argument('--no_pho_files', dest='keep_pho', action='store_false',
+                        help='do not write the pho files, only the wav files and meta-data')
 
     args = parser.parse_args()
 
-    create_basic_corpus(args.output_corpus_path, args.output_info, args.mbrola_path, args.mbrola_voices_path)
+    create_basic_corpus(args.output_corpus_path, args.output_info, args.mbrola_path, args.mbrola_voices_path,
+                        args.keep_pho)
 
     sys.exit(0)